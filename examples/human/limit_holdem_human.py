@@ -3,19 +3,16 @@
 
 import rlcard
 from rlcard import models
-from rlcard.agents import LimitholdemHumanAgent as HumanAgent, MYDQNAgentV2
-from rlcard.agents import RandomAgent, MYDQNAgent
+from rlcard.agents import LimitholdemHumanAgent as HumanAgent
 from rlcard.utils.utils import print_card
-import os
+
 # Make environment
 env = rlcard.make('limit-holdem')
 human_agent = HumanAgent(env.num_actions)
-human_agent2 = HumanAgent(env.num_actions)
-agent_0 = RandomAgent(num_actions=env.num_actions)
 dqn_agent = models.load('limit_holdem_dqn').agents[0]
 
 env.set_agents([
-    human_agent2,
+    human_agent,
     dqn_agent,
 ])
 
@@ -30,15 +27,7 @@ while (True):
     if len(trajectories[0]) != 0:
         final_state = trajectories[0][-1]
         action_record = final_state['action_record']
-        state = final_state['raw_obs']
-        _action_list = []
-        for i in range(1, len(action_record)+1):
-            """
-            if action_record[-i][0] == state['current_player']:
-                break
-            """
-            _action_list.insert(0, action_record[-i])
-        for pair in _action_list:
+        for pair in action_record:
             print('>> Player', pair[0], 'chooses', pair[1])
 
     # Let's take a look at what the agent card is
@@ -158,6 +158,29 @@ class DQNAgent(object):
 
         return legal_actions[action_idx]
 
+    def batch_step(self, states):
+        ''' Predict the actions of a batch of states for generating training data,
+            the Q-values of all the states come from one forward pass
+
+        Args:
+            states (list): a list of states
+
+        Returns:
+            actions (list): an action id per state
+        '''
+        q_values = self.q_estimator.predict_nograd(np.stack([state['obs'] for state in states]))
+        epsilon = self.epsilons[min(self.total_t, self.epsilon_decay_steps-1)]
+        actions = []
+        for state, state_q_values in zip(states, q_values):
+            legal_actions = list(state['legal_actions'].keys())
+            probs = np.ones(len(legal_actions), dtype=float) * epsilon / len(legal_actions)
+            best_action_idx = np.argmax(state_q_values[legal_actions])
+            probs[best_action_idx] += (1.0 - epsilon)
+            action_idx = np.random.choice(np.arange(len(probs)), p=probs)
+            actions.append(legal_actions[action_idx])
+
+        return actions
+
     def eval_step(self, state):
         ''' Predict the action for evaluation purpose.
 
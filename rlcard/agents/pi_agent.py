@@ -281,10 +281,10 @@ dp
             action_probs[best_action] = 1
             self.policy[obs1] = action_probs
         elif obs not in policy.keys():
-            action_probs = policy[obs1].copy()
+            action_probs = policy[obs1]
         else:
             print('1')
-            action_probs = policy[obs].copy()
+            action_probs = policy[obs]
         action_probs = remove_illegal(action_probs, legal_actions)
         return action_probs
 
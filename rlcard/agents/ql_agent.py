@@ -135,15 +135,13 @@ dp
 
         # if new state initialize qualities and policy
         if obs not in policy.keys() and obs not in self.qualities.keys():
-            tactions = np.array([-np.inf for action in range(self.env.num_actions)])
-            for action in range(self.env.num_actions):
-                if action in legal_actions:
-                    tactions[action] = 0
+            tactions = np.full(self.env.num_actions, -np.inf)
+            tactions[legal_actions] = 0
             self.qualities[obs] = tactions
             action_probs = softmax(tactions)
             self.policy[obs] = action_probs
         else:
-            action_probs = policy[obs].copy()
+            action_probs = policy[obs]
         action_probs = remove_illegal(action_probs, legal_actions)
         return action_probs
 
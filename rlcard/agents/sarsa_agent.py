@@ -1,44 +1,202 @@
 import collections
-from scipy.special import softmax
+import multiprocessing
 import os
 import pickle
 
 from rlcard.utils.utils import *
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        ''' Run the kernels as plain python when numba is not installed
+        '''
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+def _softmax(x):
+    ''' Numerically stable softmax, -inf entries (illegal actions) get probability 0
+
+    Args:
+        x (numpy.array): The qualities of a state
+
+    Returns:
+        (numpy.array): The action probabilities
+    '''
+    e = np.exp(x - x.max())
+    return e / e.sum()
+
+
+def _batch_softmax(Q):
+    ''' Softmax of every row of a table at once
+
+    Args:
+        Q (numpy.array): The qualities of the states, a row per state
+
+    Returns:
+        (numpy.array): The action probabilities of the states
+    '''
+    e = np.exp(Q - Q.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+@njit(cache=True)
+def _update_qualities(qf, actions, values, alpha):
+    ''' Move the qualities of the given actions towards their new values
+
+    Args:
+        qf (numpy.array): The qualities of the state, updated in place
+        actions (numpy.array): int32 indices of the updated actions
+        values (numpy.array): The new value of each action
+        alpha (float): The learning rate
+    '''
+    qf[actions] = qf[actions] + alpha * (values - qf[actions])
+
+
+@njit(cache=True)
+def _expected_value(probs, actions, values):
+    ''' Weight the value of each action with its probability
+
+    Args:
+        probs (numpy.array): The action probabilities of the state
+        actions (numpy.array): int32 indices of the actions
+        values (numpy.array): The value of each action
+
+    Returns:
+        value (float): Sum(prob(action)*value(action))
+    '''
+    return (probs[actions] * values).sum()
+
+
+def _train_worker(args):
+    ''' Train a copy of the agent in a worker process
+
+    Args:
+        args (tuple): The agent copy, the seed of the worker and the number of iterations
+
+    Returns:
+        (tuple) that contains:
+            obs_to_idx (dict): The rows of the states seen by the worker
+            Q (numpy.array): The qualities learned by the worker
+    '''
+    agent, seed, num_iterations = args
+    agent.env.seed(seed)
+    np.random.seed(seed)
+    for _ in range(num_iterations):
+        agent.train()
+    return agent.obs_to_idx, agent.Q[:len(agent.obs_to_idx)]
+
+
+class _Frame:
+    ''' A node of our agent in SARSAAgent.traverse_tree waiting for the values of its actions
+    '''
+    __slots__ = ('obs', 'legal_actions', 'actions', 'action_probs', 'quality', 'k', 'opponent_actions')
+
+    def __init__(self, obs, legal_actions, actions, action_probs):
+        self.obs = obs
+        self.legal_actions = legal_actions
+        self.actions = actions
+        # stored policies are already zero on illegal actions and normalized
+        self.action_probs = action_probs
+        self.quality = np.empty(len(legal_actions), dtype=np.float32)  # value of each action
+        self.k = 0
+        # prefetched move of the other agent after each action, None if not decided yet
+        self.opponent_actions = None
+
 
 class SARSAAgent:
     ''' Implement SARSA algorithm
     '''
 
-    def __init__(self, env, model_path='./sarsa_model', alpha=0.1, gamma=0.4):
+    def __init__(self, env, model_path='./sarsa_model', alpha=0.1, gamma=0.4, cache_opponent_actions=False,
+                 batch_opponent_actions=False):
         ''' Initialize Agent
          Args:
          env (Env): Env class
          hyperparameters: alpha, gamma: default the optimal found be tune_ql
+         cache_opponent_actions (bool): Reuse the action of another agent for the same state
+             during an iteration, only for agents that always play the same action in a state
+         batch_opponent_actions (bool): Decide the moves of agents with a batch_step method
+             after all the actions of a state of our agent with one call. Every move is still
+             used once, so stochastic agents keep sampling per visit, but each action costs an
+             extra env step, so it only pays off when the other agent is slow to decide
         '''
         self.gamma = gamma
         self.alpha = alpha
+        self.cache_opponent_actions = cache_opponent_actions
+        self.batch_opponent_actions = batch_opponent_actions
         self.agent_id = 0
         self.use_raw = False
         self.env = env
+        self.num_actions = env.num_actions
         self.model_path = model_path
 
-        # A policy is a dict state_str -> action probabilities
-        self.policy = collections.defaultdict(list)
-        self.a = len(self.policy)
-        # Regret is a dict state_str -> action regrets
-        self.qualities = collections.defaultdict(list)
+        # The row of every seen state in the tables, a dict state_str -> row
+        self.obs_to_idx = {}
+        self.a = len(self.obs_to_idx)
+        # Qualities, a row of action qualities per state, -inf for illegal actions
+        self.Q = np.empty((0, self.num_actions), dtype=np.float32)
+        # Policy, a row of action probabilities per state
+        self.P = np.empty((0, self.num_actions), dtype=np.float32)
+        # New qualities of a batched iteration, a dict state_str -> (int32 legal actions, list of qualities)
+        self._pending = None
+        # Actions of the other agents in this iteration, a dict (player_id, state_str) -> action
+        self._opponent_actions = {}
+        # If the actions of other agents are decided in batches
+        self._batch_opponents = False
 
         self.iteration = 0
 
-    def train(self):
+    def train(self, batch_size=1):
         ''' Do one iteration of Sarsa
+
+        Args:
+            batch_size (int): The traversals of the iteration. With more than one, all the
+                traversals read the policy of the start of the iteration and the new qualities
+                of every state are averaged and applied once at the end of it
         '''
         self.iteration += 1
-        self.a = len(self.policy)
-        self.env.reset()
+        self.a = len(self.obs_to_idx)
+        self._opponent_actions = {}
         self.find_agent()
-        self.traverse_tree()
+        if batch_size == 1:
+            self.env.reset()
+            self.traverse_tree()
+            return
+
+        self._pending = {}
+        for _ in range(batch_size):
+            self.env.reset()
+            self.traverse_tree()
+        pending, self._pending = self._pending, None
+        for obs, (actions, qualities) in pending.items():
+            self.update_policy(obs, np.mean(qualities, axis=0), actions)
+
+    def train_parallel(self, num_workers, num_iterations=1):
+        ''' Do iterations of Sarsa on independent copies of the agent (root parallelization)
+
+        Every worker process trains its own copy with a different seed, then the
+        qualities of the workers are averaged and the policy is rebuilt from them.
+
+        Args:
+            num_workers (int): The number of worker processes
+            num_iterations (int): The iterations each worker does
+        '''
+        jobs = [(self, self.iteration + worker_id, num_iterations) for worker_id in range(num_workers)]
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(_train_worker, jobs)
+
+        merged = collections.defaultdict(list)
+        for obs_to_idx, Q in results:
+            for obs, idx in obs_to_idx.items():
+                merged[obs].append(Q[idx])
+        self.obs_to_idx = {obs: idx for idx, obs in enumerate(merged)}
+        self.Q = np.array([np.mean(qfs, axis=0) for qfs in merged.values()],
+                          dtype=np.float32).reshape(-1, self.num_actions)
+        self.P = _batch_softmax(self.Q)
+        self.iteration += num_workers * num_iterations
 
     def find_agent(self):
         ''' Find if the agent starts first or second
@@ -48,6 +206,8 @@ class SARSAAgent:
             if isinstance(agent, SARSAAgent):
                 self.agent_id = id
                 break
+        self._batch_opponents = self.batch_opponent_actions and any(
+            hasattr(agent, 'batch_step') for id, agent in enumerate(agents) if id != self.agent_id)
 
     def traverse_tree(self):
         ''' Traverse the game tree:
@@ -57,89 +217,191 @@ class SARSAAgent:
                 If our agent plays check every possible action and get the Q value of the action
                 Then return the Vstate of current state which is Sum(prob(actiona)*V(next_state,actiona)) (on policy)
                 Change the policy according to the new Q values
-                '''
-        if self.env.is_over():
-            chips = self.env.get_payoffs()
-            return chips[self.agent_id]
-
-        current_player = self.env.get_player_id()
-        # compute the quality of previous state
-        if not current_player == self.agent_id:
-            state = self.env.get_state(current_player)
-            # other agent move
-            action = self.env.agents[current_player].step(state)
-
-            # Keep traversing the child state
-            self.env.step(action)
-            Vstate = self.traverse_tree()
-            self.env.step_back()
-            return Vstate
 
-        if current_player == self.agent_id:
-            quality = {}
-            value = 0
-            obs, legal_actions = self.get_state(current_player)
-            action_probs = self.action_probs(obs, legal_actions, self.policy, self.qualities)
-            for action in legal_actions:
-                action_prob = action_probs[action]
+                The tree is searched depth first with an explicit stack instead of recursion,
+                a frame per node of our agent and None for a move of the other agents
+                '''
+        stack = []
+        value = None
+        # the move of the other agent decided by the parent for the current node
+        prefetched = None
+        while True:
+            if value is None:
+                # entered a new node
+                if self.env.is_over():
+                    chips = self.env.get_payoffs()
+                    value = chips[self.agent_id]
+                    continue
+
+                current_player = self.env.get_player_id()
+                if not current_player == self.agent_id:
+                    # other agent move
+                    if prefetched is None:
+                        state = self.env.get_state(current_player)
+                        action = self.opponent_step(current_player, state)
+                    else:
+                        action, prefetched = prefetched, None
+                    stack.append(None)
+                else:
+                    obs, legal_actions, actions, idx = self.get_state(current_player)
+                    frame = _Frame(obs, legal_actions, actions, self.P[idx])
+                    stack.append(frame)
+                    if self._batch_opponents and len(legal_actions) > 1:
+                        frame.opponent_actions = self.prefetch_opponent_actions(legal_actions)
+                        prefetched = frame.opponent_actions[0]
+                    action = frame.legal_actions[0]
 
                 # Keep traversing the child state
                 self.env.step(action)
-                q = self.traverse_tree()
-                self.env.step_back()
+                continue
 
-                value += action_prob * q
-                quality[action] = q  # value of each action
+            # a node returned its value to its parent
+            if not stack:
+                return value
+            self.env.step_back()
+            frame = stack[-1]
+            if frame is None:
+                # the Vstate of the other agent move is the Vstate of its child
+                stack.pop()
+                continue
+
+            frame.quality[frame.k] = value
+            frame.k += 1
+            if frame.k < len(frame.legal_actions):
+                # Keep traversing the next child state
+                if frame.opponent_actions is not None:
+                    prefetched = frame.opponent_actions[frame.k]
+                self.env.step(frame.legal_actions[frame.k])
+                value = None
+                continue
+
+            stack.pop()
+            value = _expected_value(frame.action_probs, frame.actions, frame.quality)
 
             ''' alter policy according to new Vactions'''
-            self.update_policy(obs, quality, legal_actions)
+            if self._pending is None:
+                self.update_policy(frame.obs, frame.quality, frame.actions)
+            else:
+                self._pending.setdefault(frame.obs, (frame.actions, []))[1].append(frame.quality)
+
+            value = value*self.gamma
+
+    def opponent_step(self, player_id, state):
+        ''' Get the action of another agent, reused for the same state during an iteration
+        if cache_opponent_actions is set
+
+        Args:
+            player_id (int): The id of the other agent
+            state (dict): The state of the other agent
+
+        Returns:
+            action (int): The action of the other agent
+        '''
+        if not self.cache_opponent_actions:
+            return self.env.agents[player_id].step(state)
+
+        key = (player_id, state['obs'].tobytes())
+        action = self._opponent_actions.get(key)
+        if action is None:
+            action = self.env.agents[player_id].step(state)
+            self._opponent_actions[key] = action
+        return action
+
+    def prefetch_opponent_actions(self, legal_actions):
+        ''' Decide the moves of the other agents right after each of our legal actions with
+        one batch_step call per agent, so a single forward pass serves all the sibling branches
+
+        Every action steps the env once more to see the state of the other agent. Moves
+        already in the opponent action cache are reused instead of decided again.
 
-        return value*self.gamma
+        Args:
+            legal_actions (list): Our legal actions in the current state
+
+        Returns:
+            opponent_actions (list): The move of the other agent after each action, None
+            where the game ends, our agent plays or the other agent has no batch_step
+        '''
+        opponent_actions = [None] * len(legal_actions)
+        pending = collections.defaultdict(list)
+        for k, action in enumerate(legal_actions):
+            self.env.step(action)
+            if not self.env.is_over():
+                player_id = self.env.get_player_id()
+                if not player_id == self.agent_id and hasattr(self.env.agents[player_id], 'batch_step'):
+                    state = self.env.get_state(player_id)
+                    key = (player_id, state['obs'].tobytes())
+                    if key in self._opponent_actions:
+                        opponent_actions[k] = self._opponent_actions[key]
+                    else:
+                        pending[player_id].append((k, key, state))
+            self.env.step_back()
 
-    def action_probs(self, obs, legal_actions, policy, action_values):
-        ''' Obtain the action probabilities(policy) of the current state
-        or create a new policy
+        for player_id, children in pending.items():
+            actions = self.env.agents[player_id].batch_step([state for _, _, state in children])
+            for (k, key, _), action in zip(children, actions):
+                opponent_actions[k] = action
+                if self.cache_opponent_actions:
+                    self._opponent_actions[key] = action
+        return opponent_actions
+
+    def get_index(self, obs, legal_actions):
+        ''' Get the row of the state in the tables, adding it if it is new
 
         Args:
             obs (str): state_str
-            legal_actions (list): List of legal actions
-            player_id (int): The current player
-            policy (dict): The used policy
-            action_values (dict): The action_values of policy
+            legal_actions (numpy.array): int32 indices of legal actions
 
         Returns:
-            (tuple) that contains:
-                action_probs(numpy.array): The action probabilities
-                legal_actions (list): Indices of legal actions
+            idx (int): The row of the state
         '''
+        idx = self.obs_to_idx.get(obs)
         # if new state initialize qualities and policy
-        if obs not in policy.keys() and obs not in self.qualities.keys():
-            tactions = np.array([-np.inf for action in range(self.env.num_actions)])
-            for action in range(self.env.num_actions):
-                if action in legal_actions:
-                    tactions[action] = 0
-            self.qualities[obs] = tactions
-            action_probs = softmax(tactions)
-            self.policy[obs] = action_probs
-        else:
-            action_probs = policy[obs].copy()
-        action_probs = remove_illegal(action_probs, legal_actions)
-        return action_probs
+        if idx is None:
+            idx = self.add_state(obs, legal_actions)
+        return idx
+
+    def add_state(self, obs, legal_actions):
+        ''' Give a new state the next row of the tables
+
+        Args:
+            obs (str): state_str
+            legal_actions (numpy.array): int32 indices of legal actions
+
+        Returns:
+            idx (int): The row of the state
+        '''
+        idx = len(self.obs_to_idx)
+        if idx == self.Q.shape[0]:
+            self._grow()
+        self.obs_to_idx[obs] = idx
+        self.Q[idx, legal_actions] = 0
+        self.P[idx] = _softmax(self.Q[idx])
+        return idx
+
+    def _grow(self):
+        ''' Double the rows of the tables, new qualities start at -inf
+        '''
+        capacity = max(2 * self.Q.shape[0], 64)
+        Q = np.full((capacity, self.num_actions), -np.inf, dtype=np.float32)
+        P = np.zeros((capacity, self.num_actions), dtype=np.float32)
+        Q[:self.Q.shape[0]] = self.Q
+        P[:self.P.shape[0]] = self.P
+        self.Q, self.P = Q, P
 
     def update_policy(self, obs, next_state_values, legal_actions):
         ''' Update the policy according to the new state/action quality
                 Args:
                     obs (str): state_str
-                    next_state_values (list): The new qualities of the current iteration
+                    next_state_values (numpy.array): The new qualities of the current iteration
+                    legal_actions (numpy.array): int32 indices of the actions of next_state_values
          '''
         # update the quality function
-        qf = self.qualities[obs]
-        for i in next_state_values:
-            qf[i] += self.alpha * (next_state_values[i] - qf[i])
+        idx = self.obs_to_idx[obs]
+        qf = self.Q[idx]
+        _update_qualities(qf, legal_actions, next_state_values, self.alpha)
 
-        # update action values
-        self.qualities[obs] = qf
-        self.policy[obs] = softmax(qf)
+        # update action values, illegal actions keep a -inf quality so they are masked out
+        self.P[idx] = _softmax(qf)
 
     def eval_step(self, state):
         ''' Given a state, predict action based on average policy
@@ -152,14 +414,14 @@ class SARSAAgent:
             info (dict): A dictionary containing information
         '''
 
-        probs = self.action_probs(state['obs'].tostring(), list(state['legal_actions'].keys()), self.policy,
-                                  self.qualities)
-        #action = np.random.choice(len(probs), p=probs)
-        action = np.argmax(probs)
+        obs, legal_actions, _, idx = self.encode_state(state)
+        # softmax keeps the order of the qualities, illegal actions are -inf
+        action = int(self.Q[idx].argmax())
 
+        probs = self.P[idx]
         info = {}
-        info['probs'] = {state['raw_legal_actions'][i]: float(probs[list(state['legal_actions'].keys())[i]]) for i in
-                         range(len(state['legal_actions']))}
+        info['probs'] = {state['raw_legal_actions'][i]: float(probs[legal_actions[i]]) for i in
+                         range(len(legal_actions))}
 
         return action, info
 
@@ -178,9 +440,28 @@ class SARSAAgent:
             (tuple) that contains:
                 state (str): The state str
                 legal_actions (list): Indices of legal actions
+                actions (numpy.array): int32 indices of legal actions
+                idx (int): The row of the state in the tables
         '''
-        state = self.env.get_state(player_id)
-        return state['obs'].tostring(), list(state['legal_actions'].keys())
+        return self.encode_state(self.env.get_state(player_id))
+
+    def encode_state(self, state):
+        ''' Get the state_str, legal actions and table row of a state
+
+        Args:
+            state (dict): The state of the env
+
+        Returns:
+            (tuple) that contains:
+                state (str): The state str
+                legal_actions (list): Indices of legal actions
+                actions (numpy.array): int32 indices of legal actions
+                idx (int): The row of the state in the tables
+        '''
+        obs = state['obs'].tobytes()
+        legal_actions = list(state['legal_actions'].keys())
+        actions = np.array(legal_actions, dtype=np.int32)
+        return obs, legal_actions, actions, self.get_index(obs, actions)
 
     def save(self):
         '''  Save model
@@ -189,33 +470,45 @@ class SARSAAgent:
         if not os.path.exists(self.model_path):
             os.makedirs(self.model_path)
 
-        policy_file = open(os.path.join(self.model_path, 'policy.pkl'),'wb')
-        pickle.dump(self.policy, policy_file)
-        policy_file.close()
-
-        values_file = open(os.path.join(self.model_path, 'qualities.pkl'),'wb')
-        pickle.dump(self.qualities, values_file)
-        values_file.close()
-
-        iteration_file = open(os.path.join(self.model_path, 'iteration.pkl'),'wb')
-        pickle.dump(self.iteration, iteration_file)
-        iteration_file.close()
+        num_states = len(self.obs_to_idx)
+        model = {
+            'obs_to_idx': self.obs_to_idx,
+            'qualities': self.Q[:num_states],
+            'iteration': self.iteration,
+        }
+        # write a temporary file and rename it, so a crash while saving keeps the previous model
+        model_path = os.path.join(self.model_path, 'model.pkl')
+        with open(model_path + '.tmp', 'wb') as model_file:
+            # protocol 4 is the highest one python 3.7 can load
+            pickle.dump(model, model_file, protocol=4)
+        os.replace(model_path + '.tmp', model_path)
 
     def load(self):
-        ''' Load model
+        ''' Load model, either a model.pkl or the qualities.pkl and iteration.pkl of older
+        saves. The policy is rebuilt from the qualities
         '''
 
         if not os.path.exists(self.model_path):
             return
 
-        policy_file = open(os.path.join(self.model_path, 'policy.pkl'),'rb')
-        self.policy = pickle.load(policy_file)
-        policy_file.close()
-
-        values_file = open(os.path.join(self.model_path, 'qualities.pkl'),'rb')
-        self.qualities = pickle.load(values_file)
-        values_file.close()
-
-        iteration_file = open(os.path.join(self.model_path, 'iteration.pkl'),'rb')
-        self.iteration = pickle.load(iteration_file)
-        iteration_file.close()
\ No newline at end of file
+        model_path = os.path.join(self.model_path, 'model.pkl')
+        if os.path.exists(model_path):
+            with open(model_path, 'rb') as model_file:
+                model = pickle.load(model_file)
+        else:
+            model = {}
+            for key in ['qualities', 'iteration']:
+                with open(os.path.join(self.model_path, key + '.pkl'), 'rb') as key_file:
+                    model[key] = pickle.load(key_file)
+
+        if isinstance(model['qualities'], dict):
+            # older saves keep a dict state_str -> qualities
+            states = list(model['qualities'].keys())
+            model['obs_to_idx'] = {obs: idx for idx, obs in enumerate(states)}
+            model['qualities'] = [model['qualities'][obs] for obs in states]
+
+        shape = (len(model['obs_to_idx']), self.num_actions)
+        self.obs_to_idx = model['obs_to_idx']
+        self.Q = np.array(model['qualities'], dtype=np.float32).reshape(shape)
+        self.P = _batch_softmax(self.Q)
+        self.iteration = model['iteration']
@@ -244,7 +244,8 @@ def remove_illegal(action_probs, legal_actions):
         legal_actions (list): A list of indices of legal actions.
 
     Returns:
-        probd (numpy.array): A normalized vector without legal actions.
+        probd (numpy.array): A normalized vector without legal actions. It is a new
+            vector, action_probs is not modified.
     '''
     probs = np.zeros(action_probs.shape[0])
     probs[legal_actions] = action_probs[legal_actions]
@@ -51,3 +51,17 @@ class TestDQN(unittest.TestCase):
         predicted_action = agent.step({'obs': np.random.random_sample((2,)), 'legal_actions': {0: None, 1: None}})
         self.assertGreaterEqual(predicted_action, 0)
         self.assertLessEqual(predicted_action, 1)
+
+    def test_batch_step(self):
+
+        agent = DQNAgent(replay_memory_size = 200,
+                         replay_memory_init_size=100,
+                         update_target_estimator_every=100,
+                         state_shape=[2],
+                         mlp_layers=[10,10],
+                         device=torch.device('cpu'))
+
+        predicted_actions = agent.batch_step([{'obs': np.random.random_sample((2,)), 'legal_actions': {0: None, 1: None}},
+                                              {'obs': np.random.random_sample((2,)), 'legal_actions': {1: None}}])
+        self.assertIn(predicted_actions[0], [0, 1])
+        self.assertEqual(predicted_actions[1], 1)
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+import rlcard
+from rlcard.agents.sarsa_agent import SARSAAgent
+from rlcard.agents.random_agent import RandomAgent
+
+class FirstActionAgent(RandomAgent):
+    ''' Always plays the first legal action
+    '''
+
+    @staticmethod
+    def step(state):
+        return list(state['legal_actions'].keys())[0]
+
+class BatchFirstActionAgent(FirstActionAgent):
+    ''' Always plays the first legal action, counting its batched decisions
+    '''
+
+    def __init__(self, num_actions):
+        super().__init__(num_actions)
+        self.num_batched = 0
+
+    def batch_step(self, states):
+        self.num_batched += len(states)
+        return [self.step(state) for state in states]
+
+class TestSARSA(unittest.TestCase):
+
+    def _make_agent(self, opponent_class=RandomAgent, model_path='experiments/sarsa_model', **kwargs):
+        env = rlcard.make('new-limit-holdem', config={'allow_step_back':True, 'seed':0})
+        agent = SARSAAgent(env, model_path=model_path, **kwargs)
+        env.set_agents([agent, opponent_class(num_actions=env.num_actions)])
+        return agent
+
+    def _assert_policy_normalized(self, agent):
+        num_states = len(agent.obs_to_idx)
+        self.assertGreater(num_states, 0)
+        np.testing.assert_allclose(agent.P[:num_states].sum(axis=1), 1.0, rtol=1e-5)
+
+    def test_train(self):
+        agent = self._make_agent()
+
+        for _ in range(100):
+            agent.train()
+
+        self._assert_policy_normalized(agent)
+
+        state = agent.env.reset()[0]
+        action, info = agent.eval_step(state)
+
+        self.assertIn(action, list(state['legal_actions'].keys()))
+        self.assertEqual(set(info['probs'].keys()), set(state['raw_legal_actions']))
+
+    def test_train_batch(self):
+        agent = self._make_agent()
+
+        for _ in range(10):
+            agent.train(batch_size=10)
+
+        self.assertEqual(agent.iteration, 10)
+        self._assert_policy_normalized(agent)
+
+    def test_cache_opponent_actions(self):
+        agent = self._make_agent(FirstActionAgent)
+        cached_agent = self._make_agent(FirstActionAgent, cache_opponent_actions=True)
+
+        for _ in range(50):
+            agent.train()
+            cached_agent.train()
+
+        self.assertEqual(agent._opponent_actions, {})
+        self.assertGreater(len(cached_agent._opponent_actions), 0)
+        self.assertEqual(agent.obs_to_idx, cached_agent.obs_to_idx)
+        np.testing.assert_array_equal(agent.Q, cached_agent.Q)
+
+    def test_batch_opponent_actions(self):
+        agent = self._make_agent(FirstActionAgent)
+        batched_agent = self._make_agent(BatchFirstActionAgent, batch_opponent_actions=True)
+
+        for _ in range(50):
+            agent.train()
+            batched_agent.train()
+
+        self.assertGreater(batched_agent.env.agents[1].num_batched, 0)
+        self.assertEqual(agent.obs_to_idx, batched_agent.obs_to_idx)
+        np.testing.assert_array_equal(agent.Q, batched_agent.Q)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as model_path:
+            agent = self._make_agent(model_path=model_path)
+
+            for _ in range(100):
+                agent.train()
+
+            agent.save()
+            self.assertIn('model.pkl', os.listdir(model_path))
+            self.assertNotIn('model.pkl.tmp', os.listdir(model_path))
+
+            new_agent = SARSAAgent(agent.env, model_path=model_path)
+            new_agent.load()
+        num_states = len(agent.obs_to_idx)
+        self.assertEqual(agent.obs_to_idx, new_agent.obs_to_idx)
+        self.assertEqual(new_agent.Q.dtype, np.float32)
+        np.testing.assert_array_equal(agent.Q[:num_states], new_agent.Q)
+        np.testing.assert_allclose(agent.P[:num_states], new_agent.P, rtol=1e-6)
+        self.assertEqual(agent.iteration, new_agent.iteration)
+
+    def test_train_parallel(self):
+        agent = self._make_agent()
+
+        agent.train_parallel(num_workers=2, num_iterations=10)
+
+        self.assertEqual(agent.iteration, 20)
+        self.assertEqual(agent.Q.shape, (len(agent.obs_to_idx), agent.env.num_actions))
+        self._assert_policy_normalized(agent)